@@ -6,69 +6,139 @@
   for archived versions of the transfer rules.
 """
 
+import json
 import psycopg
 import mk_requirement_dicts
+import os
 import sys
 
 from bisect import bisect
-from collections import defaultdict, namedtuple
+from collections import deque, namedtuple
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
-from psycopg.rows import namedtuple_row
+from functools import lru_cache
+from itertools import batched
+from psycopg.rows import class_row, namedtuple_row
 
 SC = namedtuple('SC', 'course_id offer_nbr min_gpa req_info')
 DC = namedtuple('DC', 'course_id offer_nbr is_pseudo req_info')
+CourseInfo = namedtuple('CourseInfo', 'course aliases credits flags requirements')
+Rule = namedtuple('Rule', 'rule_key effective_date source_courses destination_courses')
 error_log = None
+_pool = None
 
-mk_requirement_dicts.mk_dicts()
-course_info = defaultdict(dict)
-with psycopg.connect("dbname=cuny_curriculum") as conn:
-  with conn.cursor(row_factory=namedtuple_row) as cursor:
-    # Cache course info dicts
-    cursor.execute("""
-    select institution, course_id, offer_nbr,
-        discipline||' '||catalog_number as course,
-        min_credits, max_credits,
-        designation in ('MLA', 'MNL') as is_mesg,
-        attributes ~* 'bkcr' as is_bkcr,
-        course_status, career,
-        requirements
-      from cuny_courses
-    """)
-    for row in cursor.fetchall():
-      credits = row.max_credits if row.min_credits == row.max_credits else 'varies'
-      requirements = row.requirements
-      course_info[row.course_id][row.offer_nbr] = {'institution': row.institution,
-                                                   'course': row.course,
-                                                   'credits': credits,
-                                                   'is_mesg': row.is_mesg,
-                                                   'is_bkcr': row.is_bkcr,
-                                                   'status': row.course_status,
-                                                   'career': row.career,
-                                                   'requirements': requirements}
+# Loaded by describe_rules() or ensure_course_info(); worker processes get it from _init_worker().
+course_info: dict[tuple[int, int], CourseInfo] = {}
+# All the offers of each course_id, formatted as aliases for rules that reference an offer_nbr
+# cuny_courses doesn't have.
+course_aliases: dict[int, str] = {}
+
+
+# load_course_info()
+# -------------------------------------------------------------------------------------------------
+def load_course_info() -> tuple[dict, dict]:
+  """Cache course info, keyed by (course_id, offer_nbr), and the aliases for each course_id.
+
+      The course-level parts of a description are built here, once per course, rather than each
+      time a course appears in a rule: the db formats the aliases (other offer_nbrs of the same
+      course_id) and the message/blanket-credit flags, and the requirements are formatted with
+      format_requirements().
+  """
+  with psycopg.connect("dbname=cuny_curriculum") as conn:
+    with conn.cursor(row_factory=namedtuple_row) as cursor:
+      cursor.execute("""
+      select c.course_id, c.offer_nbr,
+          c.discipline||' '||c.catalog_number as course,
+          coalesce(' (=' || (select string_agg(a.discipline||' '||a.catalog_number, ','
+                                               order by a.offer_nbr)
+                               from cuny_courses a
+                              where a.course_id = c.course_id
+                                and a.offer_nbr <> c.offer_nbr) || ')', '') as aliases,
+          c.min_credits, c.max_credits,
+          case when c.designation in ('MLA', 'MNL') then 'M' else '-' end ||
+          case when c.attributes ~* 'bkcr' then 'B' else '-' end as flags,
+          c.requirements
+        from cuny_courses c
+      """)
+      info = {(row.course_id, row.offer_nbr):
+              CourseInfo(row.course, row.aliases,
+                         row.max_credits if row.min_credits == row.max_credits else 'varies',
+                         row.flags, format_requirements(row.requirements))
+              for row in cursor}
+
+      cursor.execute("""
+      select course_id,
+             ' (=' || string_agg(discipline||' '||catalog_number, ',' order by offer_nbr) || ')'
+               as aliases
+        from cuny_courses
+       group by course_id
+      """)
+      aliases = {row.course_id: row.aliases for row in cursor}
+  return info, aliases
+
+
+# ensure_course_info()
+# -------------------------------------------------------------------------------------------------
+def ensure_course_info():
+  """Make sure course_info is loaded before calling describe_rule() on get_rule_info() results.
+
+      The first call updates the cuny_courses requirements column, so it exists and is current, and
+      loads course_info and course_aliases from it; later calls do nothing.
+  """
+  global course_info, course_aliases
+  if not course_info:
+    mk_requirement_dicts.mk_dicts()
+    course_info, course_aliases = load_course_info()
+
+
+# _init_worker()
+# -------------------------------------------------------------------------------------------------
+def _init_worker(worker_course_info: dict, worker_course_aliases: dict, error_log_name: str):
+  """Give a describe_rules worker process the parent's course_info, aliases, and error log."""
+  global course_info, course_aliases, error_log
+  course_info = worker_course_info
+  course_aliases = worker_course_aliases
+  error_log = open(error_log_name, 'a', buffering=1)
 
 
 # min_grade()
 # -------------------------------------------------------------------------------------------------
+_GRADE_BREAKPOINTS = (0.7, 1.0, 1.3, 1.7, 2.0, 2.3, 2.7, 3.0, 3.3, 3.7, 4.0, 4.3)
+_GRADE_LETTERS = ('P', 'D-', 'D', 'D+', 'C-', 'C', 'C+', 'B-', 'B', 'B+', 'A-', 'A', 'A+')
+
+
+@lru_cache(maxsize=64)
 def min_grade(min_gpa) -> str:
   """Convert min_gpa to a letter-grade string.
 
-  If gpa is lt 0.7, assume “any passing grade” (P)
+  If gpa is lt 0.7 or missing (NULL), assume “any passing grade” (P)
+  Cached: rules use only a handful of distinct min_gpa values.
   """
-  breakpoints = [0.7, 1.0, 1.3, 1.7, 2.0, 2.3, 2.7, 3.0, 3.3, 3.7, 4.0, 4.3]
-  letters = ['P', 'D-', 'D', 'D+', 'C-', 'C', 'C+', 'B-', 'B', 'B+', 'A-', 'A', 'A+']
-  return letters[bisect(breakpoints, float(min_gpa))]
+  if min_gpa is None:
+    return 'P'
+  return _GRADE_LETTERS[bisect(_GRADE_BREAKPOINTS, float(min_gpa))]
 
 
 # format_requirements()
 # -------------------------------------------------------------------------------------------------
+_COPT_CODES = ('--', 'CO')
+_EQUIV_CODES = ('--', 'ME')
+_requirements_prefixes = dict()
+
+
 def format_requirements(requirements: dict) -> str:
-  """Generate a string description from a requirements dict."""
+  """Generate a string description from a requirements dict.
+
+      The pways:copt:equiv prefix takes few distinct values, so it is built once per combination
+      and only the plan count is formatted per call.
+  """
   if not requirements:
     return '--:--:--:000'
-  return (f'{requirements['pways'] if requirements['pways'] else '--'}'
-          f':{'CO' if requirements['copt'] else '--'}'
-          f':{'ME' if requirements['equiv'] else '--'}'
-          f':{len(requirements['plans']):03}')
+  key = (requirements['pways'] or '--', bool(requirements['copt']), bool(requirements['equiv']))
+  if (prefix := _requirements_prefixes.get(key)) is None:
+    prefix = _requirements_prefixes[key] = f'{key[0]}:{_COPT_CODES[key[1]]}:{_EQUIV_CODES[key[2]]}'
+  return f'{prefix}:{len(requirements['plans']):03}'
 
 
 # oxfordize()
@@ -87,18 +157,49 @@ def oxfordize(things: list, conjunction: str = 'and') -> str:
   return ', '.join(things[0:-1]) + f', {conjunction} {things[-1]}'
 
 
+# _get_pool()
+# -------------------------------------------------------------------------------------------------
+def _get_pool():
+  """Create the connection pool used by get_rule_info() the first time it is needed.
+
+      prepare_threshold=0 has each connection prepare the rule query on first use.
+      psycopg_pool is imported here so that generating the rule_descriptions table, which doesn't
+      use the pool, doesn't require it.
+  """
+  global _pool
+  if _pool is None:
+    from psycopg_pool import ConnectionPool
+    _pool = ConnectionPool('dbname=cuny_curriculum', min_size=1, max_size=4,
+                           kwargs={'prepare_threshold': 0}, open=True)
+  return _pool
+
+
 # get_rule_info()
 # -------------------------------------------------------------------------------------------------
 def get_rule_info(rule_key: str) -> namedtuple:
   """Query to get course info for a single rule.
 
-      Uses current information about courses, which might be inappropriate.
+      Uses current information about courses, which might be inappropriate. Call
+      ensure_course_info() before passing the result to describe_rule().
   """
-  with psycopg.connect('dbname=cuny_curriculum') as conn:
+  return get_rule_infos([rule_key]).get(rule_key)
+
+
+# get_rule_infos()
+# -------------------------------------------------------------------------------------------------
+def get_rule_infos(rule_keys: list) -> dict:
+  """Query to get course info for a list of rules in one round trip.
+
+      Returns a dict of rows keyed by rule_key; rule_keys that are not found are omitted.
+      Connections come from a shared pool, so repeated calls don't reconnect each time.
+  """
+  rule_infos = dict()
+  with _get_pool().connection() as conn:
     with conn.cursor(row_factory=namedtuple_row) as cursor:
       cursor.execute("""
       SELECT
         r.rule_key,
+        r.effective_date,
         COALESCE(s.source_courses, '[]'::jsonb)      AS source_courses,
         COALESCE(d.destination_courses, '[]'::jsonb) AS destination_courses
       FROM transfer_rules AS r
@@ -129,15 +230,13 @@ def get_rule_info(rule_key: str) -> namedtuple:
           WHERE dc.rule_id = r.id
         ) AS y
       ) AS d ON TRUE
-      WHERE r.rule_key = %s     -- or = $1
-      """, (rule_key,))
-      match cursor.rowcount:
-        case 0:
-          return None
-        case 1:
-          return cursor.fetchone()
-        case _:
-          raise ValueError(f'Multiple instances of {rule_key}')
+      WHERE r.rule_key = ANY(%s::text[])
+      """, (list(rule_keys),))
+      for row in cursor:
+        if row.rule_key in rule_infos:
+          raise ValueError(f'Multiple instances of {row.rule_key}')
+        rule_infos[row.rule_key] = row
+  return rule_infos
 
 
 # describe_rule()
@@ -148,95 +247,65 @@ def describe_rule(row: namedtuple) -> tuple:
   src_list = []
   dst_list = []
   # Gather information for all source courses
-  source_courses = [(source_course['course_id'], source_course['offer_nbr'],
-                    source_course['min_gpa'])
-                    for source_course in row.source_courses]
-
-  for course_id, offer_nbr, min_gpa in source_courses:
-    this_course = {'course_id': None,
-                   'offer_nbr': None,
-                   'course': '',
-                   'min_grade': 'P',
-                   'aliases': [],
-                   'requirements': dict
-                   }
-    src_infos = course_info[course_id]
-    for this_offer_nbr, src_info in src_infos.items():
-      if this_offer_nbr == offer_nbr:
-        # This _is_ this course: fill in the dict
-        this_course['course_id'] = course_id
-        this_course['offer_nbr'] = offer_nbr
-        this_course['course'] = src_info['course']
-        this_course['min_grade'] = min_grade(min_gpa)
-        this_course['requirements'] = format_requirements(src_info['requirements'])
-      else:
-        this_course['aliases'].append(src_info['course'])
-
-    if this_course['offer_nbr'] is None:
-      # No matching offer_nbr in src_infos → bogus rule
-      this_course['course'] = 'No course'
-      this_course['requirements'] = '[--:--:--:---]'
-      print(f'src: offer_nbr not in src_infos '
-            f'{row.rule_key:20} {course_id:06}:{offer_nbr} {min_gpa:6} {src_infos}',
+  for source_course in row.source_courses:
+    course_id = source_course['course_id']
+    offer_nbr = source_course['offer_nbr']
+    min_gpa = source_course['min_gpa']
+    if src_info := course_info.get((course_id, offer_nbr)):
+      # This _is_ this course
+      course = src_info.course
+      aliases = src_info.aliases
+      grade = min_grade(min_gpa)
+      requirements = src_info.requirements
+    else:
+      # No matching course_id:offer_nbr in course_info → bogus rule
+      course = 'No course'
+      aliases = course_aliases.get(course_id, '')
+      grade = 'P'
+      requirements = '[--:--:--:---]'
+      print(f'src: offer_nbr not in course_info '
+            f'{row.rule_key:20} {course_id:06}:{offer_nbr} {min_gpa!s:>6}',
             file=error_log)
 
-    aliases = (f' (={','.join(this_course['aliases'])})'
-               if this_course['aliases'] else '')
-    src_list.append(f'{this_course['course']}{aliases} '
-                    f'{this_course['min_grade']} '
-                    f'[{this_course['requirements']}]'
-                    )
+    src_list.append(f'{course}{aliases} {grade} [{requirements}]')
+
   # Gather the information for all destination courses
-  destination_courses = [(destination_course['course_id'],
-                          destination_course['offer_nbr'])
-                         for destination_course in row.destination_courses]
-  for course_id, offer_nbr in destination_courses:
-    this_course = {'course_id': None,
-                   'offer_nbr': None,
-                   'course': '',
-                   'mesg': False,
-                   'bkcr': False,
-                   'aliases': [],
-                   'requirements': dict
-                   }
-    dst_infos = course_info[course_id]
-    for this_offer_nbr, dst_info in dst_infos.items():
-      if this_offer_nbr == offer_nbr:
-        # This _is_ this course: fill in the dict
-        this_course['course_id'] = course_id
-        this_course['offer_nbr'] = offer_nbr
-        this_course['course'] = dst_info['course']
-        this_course['mesg'] = 'M' if dst_info['is_mesg'] else '-'
-        this_course['bkcr'] = 'B' if dst_info['is_bkcr'] else '-'
-        this_course['requirements'] = format_requirements(dst_info['requirements'])
-      else:
-        this_course['aliases'].append(dst_info['course'])
-
-    if this_course['offer_nbr'] is None:
-      # No matching offer_nbr in dst_infos → bogus rule
-      this_course['course'] = 'No course'
-      this_course['requirements'] = ''
-      print(f'dst: offer_nbr not in src_infos '
-            f'{row.rule_key:20} {course_id:06}:{offer_nbr} {min_gpa:6} {src_infos}',
+  for destination_course in row.destination_courses:
+    course_id = destination_course['course_id']
+    offer_nbr = destination_course['offer_nbr']
+    if dst_info := course_info.get((course_id, offer_nbr)):
+      # This _is_ this course
+      course = dst_info.course
+      aliases = dst_info.aliases
+      flags = dst_info.flags
+      requirements = dst_info.requirements
+    else:
+      # No matching course_id:offer_nbr in course_info → bogus rule
+      course = 'No course'
+      aliases = course_aliases.get(course_id, '')
+      flags = '--'
+      requirements = ''
+      print(f'dst: offer_nbr not in course_info '
+            f'{row.rule_key:20} {course_id:06}:{offer_nbr}',
             file=error_log)
 
-    aliases = (f' (={','.join(this_course['aliases'])})' if this_course['aliases']
-               else '')
-    dst_list.append(f'{this_course['course']}{aliases} '
-                    f'{this_course['mesg']}{this_course['bkcr']} '
-                    f'[{this_course['requirements']}]')
+    dst_list.append(f'{course}{aliases} {flags} [{requirements}]')
 
   return (row.rule_key, row.effective_date, f'{oxfordize(src_list)} => {oxfordize(dst_list)}')
 
 
 # describe_rules()
 # -------------------------------------------------------------------------------------------------
-def describe_rules(schema_name: str) -> list:
-  """Describe all the rules in a schema."""
-  global error_log
-  error_log = open(f'./description_errors.{schema_name}.log', 'w')
+def describe_rules(schema_name: str) -> Iterator[tuple]:
+  """Describe all the rules in a schema.
+
+      Checks the schema, updates the cuny_courses requirements, and reloads course_info before
+      returning, so errors surface and the setup work is done before the caller starts writing
+      the descriptions anywhere. The returned iterator yields (rule_key, effective_date,
+      description) tuples as the rules are streamed from the db.
+  """
+  global course_info, course_aliases, error_log
 
-  all_descriptions = []
   with psycopg.connect('dbname=cuny_curriculum') as conn:
     with conn.cursor(row_factory=namedtuple_row) as cursor:
       # Make sure the schema exists
@@ -273,8 +342,30 @@ def describe_rules(schema_name: str) -> list:
           from   {schema_name}.destination_courses;
         """)
 
-      # Gather the information needed to describe the rules
-      cursor.execute(f"""
+      # Descriptions are regenerated from scratch on every run; rule_courses, a materialized view
+      # of the per-rule course lists that was tried for caching them, is no longer used.
+      cursor.execute(f'drop materialized view if exists {schema_name}.rule_courses')
+
+  mk_requirement_dicts.mk_dicts()
+  course_info, course_aliases = load_course_info()
+  error_log = open(f'./description_errors.{schema_name}.log', 'w')
+
+  return _stream_descriptions(schema_name)
+
+
+# _stream_descriptions()
+# -------------------------------------------------------------------------------------------------
+def _stream_descriptions(schema_name: str) -> Iterator[tuple]:
+  """Generate the descriptions for describe_rules(), over a connection of its own."""
+  with psycopg.connect('dbname=cuny_curriculum') as conn:
+    # Gather the information needed to describe the rules. There is one row per rule, so stream
+    # them from a server-side cursor rather than fetching them all at once. Rows are Rule
+    # namedtuples (rather than namedtuple_row) so they can be pickled for the worker processes,
+    # and the course lists come back as JSON text to be parsed by _parse_rule() there: parsing
+    # them here would cost the parent as much as describing them.
+    with conn.cursor(name='rules_stream', row_factory=class_row(Rule)) as rules_cursor:
+      rules_cursor.itersize = 10_000
+      rules_cursor.execute(f"""
       WITH
       sc AS (
         SELECT rule_key,
@@ -282,8 +373,7 @@ def describe_rules(schema_name: str) -> list:
                 jsonb_build_object(
                   'course_id', course_id,
                   'offer_nbr', offer_nbr,
-                  'min_gpa',   min_gpa,
-                  'max_credits', max_credits
+                  'min_gpa',   min_gpa
                 )
                 ORDER BY course_id, offer_nbr, coalesce(min_gpa, 0.0), coalesce(max_credits, 99.0)
               ) AS source_courses
@@ -305,18 +395,46 @@ def describe_rules(schema_name: str) -> list:
       SELECT
         r.rule_key,
         r.effective_date,
-        coalesce(sc.source_courses, '[]'::jsonb) AS source_courses,
-        coalesce(dc.destination_courses, '[]'::jsonb) AS destination_courses
+        coalesce(sc.source_courses, '[]'::jsonb)::text AS source_courses,
+        coalesce(dc.destination_courses, '[]'::jsonb)::text AS destination_courses
       FROM {schema_name}.transfer_rules r
       LEFT JOIN sc USING (rule_key)
       LEFT JOIN dc USING (rule_key)
-      ORDER BY r.rule_key;
-
+      ORDER BY r.rule_key
       """)
-      for row in cursor.fetchall():
-        all_descriptions.append(describe_rule(row))
+      # Describing a rule is pure Python work, so spread it across processes when there is more
+      # than one CPU to use. Chunks of rows are submitted as they are fetched, with a bounded
+      # number in flight, so fetching overlaps describing and the cursor isn't pulled in all at
+      # once; results are yielded in rule order.
+      num_workers = os.cpu_count() or 1
+      if num_workers == 1:
+        yield from (describe_rule(_parse_rule(row)) for row in rules_cursor)
+        return
+      with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                               initargs=(course_info, course_aliases, error_log.name)) as executor:
+        in_flight = deque()
+        for rows in batched(rules_cursor, _CHUNK_SIZE):
+          in_flight.append(executor.submit(_describe_chunk, rows))
+          if len(in_flight) > 2 * num_workers:
+            yield from in_flight.popleft().result()
+        while in_flight:
+          yield from in_flight.popleft().result()
+
+
+# _describe_chunk()
+# -------------------------------------------------------------------------------------------------
+_CHUNK_SIZE = 500
+
 
-  return all_descriptions
+def _describe_chunk(rows: Iterator[Rule]) -> list:
+  """Describe a chunk of rules whose course lists are JSON text, normally in a worker process."""
+  return [describe_rule(_parse_rule(row)) for row in rows]
+
+
+def _parse_rule(row: Rule) -> Rule:
+  """Parse the JSON course lists of a streamed rule."""
+  return row._replace(source_courses=json.loads(row.source_courses),
+                      destination_courses=json.loads(row.destination_courses))
 
 
 # __main__():
@@ -325,8 +443,13 @@ if __name__ == "__main__":
 
   schema_name = sys.argv[1] if len(sys.argv) > 1 else 'public'
 
-  all_descriptions = describe_rules(schema_name)
-  with conn.connect('dbname=cuny_curriculum') as conn:
+  # Do describe_rules()'s setup before opening the transaction that drops and recreates
+  # rule_descriptions, so readers of the table are locked out only while it is being filled. The
+  # descriptions are streamed over describe_rules()'s own connection while this one COPYs them
+  # into the table as they are generated.
+  descriptions = describe_rules(schema_name)
+  num_descriptions = 0
+  with psycopg.connect('dbname=cuny_curriculum') as conn:
     with conn.cursor() as cursor:
       # (Re)create the rule_descriptions table
       cursor.execute(f"""
@@ -337,14 +460,21 @@ if __name__ == "__main__":
           description    text
         )
         """)
+      # Binary COPY: no text escaping on this side or parsing on the server. Binary values must
+      # match the column types exactly, so effective_date (a date) is sent as text.
       with cursor.copy(f'copy {schema_name}.rule_descriptions '
-                       f'(rule_key, effective_date, description) from stdin') as cpy:
-        for row in all_descriptions:
-          cpy.write_row(row)
+                       f'(rule_key, effective_date, description) '
+                       f'from stdin with (format binary)') as cpy:
+        cpy.set_types(['text', 'text', 'text'])
+        for rule_key, effective_date, description in descriptions:
+          if effective_date is not None:
+            effective_date = str(effective_date)
+          cpy.write_row((rule_key, effective_date, description))
+          num_descriptions += 1
 
       if schema_name == 'public':
         cursor.execute("""
         update updates set update_date = %s where table_name = 'rule_descriptions'
         """, (date.today(),))
 
-  print(f'Generated {len(all_descriptions):,} rule_descriptions in schema {schema_name}')
+  print(f'Generated {num_descriptions:,} rule_descriptions in schema {schema_name}')
@@ -9,79 +9,119 @@
 """
 
 import psycopg
-import re
-from psycopg.rows import namedtuple_row
-from psycopg.types.json import Json
 
 
 # mk_dicts()
 # -------------------------------------------------------------------------------------------------
 def mk_dicts():
   with psycopg.connect('dbname=cuny_curriculum') as conn:
-    with conn.cursor(row_factory=namedtuple_row) as cursor:
-      cursor.execute("""
-      alter table cuny_courses
-      add column if not exists requirements json
-      """)
-
-      # Get cuny_course designation (for Pathways) and attributes (for COPT and Major Equivalencies)
-      # Get list of programs from dgw.courses
-      cursor.execute("""
-      SELECT
-        c.institution,
-        c.course_id,
-        c.offer_nbr,
-        c.discipline,
-        c.catalog_number,
-        c.designation,
-        c.attributes,
-        COALESCE(
-          array_agg(DISTINCT dc.plan ORDER BY dc.plan)
-            FILTER (WHERE dc.plan IS NOT NULL),
-          '{}'
-        ) AS plans
-      FROM cuny_courses AS c
-      LEFT JOIN dgw.courses AS dc
-        ON c.course_id = split_part(dc.course_id, ':', 1)::int
-      AND c.offer_nbr = split_part(dc.course_id, ':', 2)::int
-      WHERE c.career = 'UGRD'
-        AND c.course_status = 'A'
-      GROUP BY
-        c.institution, c.course_id, c.offer_nbr, c.discipline,
-        c.catalog_number, c.designation, c.attributes;
-      """)
-      rows = cursor.fetchall()
-      for row in rows:
-        requirements = dict()
-        attr_str = row.attributes if row.attributes else ''
-
-        # Pathways
-        if match := re.match(r'^[RF](..)[CDR]$', row.designation):
-          requirements['pways'] = match[1]
-        else:
-          requirements['pways'] = None
+    with conn.cursor() as cursor:
+      # None of these statements depends on any client-side work: send them in one pipeline
+      # rather than waiting for the server after each one, all in a single transaction.
+      with conn.transaction(), conn.pipeline():
+        # The requirements can always be recomputed, so don't wait for the WAL flush at commit.
+        cursor.execute("""
+        set local synchronous_commit = off
+        """)
 
-        requirements['copt'] = row.designation.startswith('CO') or 'COPT' in attr_str
+        cursor.execute("""
+        alter table cuny_courses
+        add column if not exists requirements json
+        """)
 
-        # Major Equivalents
-        try:
-          attr_dict = dict(part.strip().split(":", 1) for part in attr_str.split(";")
-                           if part.strip())
-          requirements['equiv'] = [attr_value for attr_key, attr_value in attr_dict.items()
-                                   if attr_key.startswith('ME')]
-        except ValueError:
-          requirements['equiv'] = None
+        # The update below, and the course lookups in mk_descriptions, match on
+        # (course_id, offer_nbr). Add a unique index on those columns unless there already is one
+        # (the primary key, for example): a duplicate would just slow down every write. Once the
+        # index exists this is only a catalog lookup. If duplicate (course_id, offer_nbr) pairs
+        # keep it from being built, warn and carry on without it rather than aborting the update.
+        cursor.execute("""
+        do $$
+        begin
+          if not exists (
+            select 1
+              from pg_index i
+             where i.indrelid = 'cuny_courses'::regclass
+               and i.indisunique
+               and i.indpred is null
+               and i.indexprs is null
+               and i.indnkeyatts = 2
+               and array(select a.attname::text
+                           from unnest(i.indkey::int2[]) with ordinality as k(attnum, n)
+                           join pg_attribute a
+                             on a.attrelid = i.indrelid
+                            and a.attnum = k.attnum
+                          where k.n <= i.indnkeyatts
+                          order by k.n) = array['course_id', 'offer_nbr'])
+          then
+            begin
+              create unique index cuny_courses_cid_off_idx on cuny_courses (course_id, offer_nbr);
+            exception when unique_violation then
+              raise warning 'cuny_courses has duplicate (course_id, offer_nbr) pairs: %', sqlerrm;
+            end;
+          end if;
+        end
+        $$
+        """)
 
-        # Program Requirements
-        # Note to self: all rows in dgw.courses have non-empty plan fields
-        requirements['plans'] = row.plans
+        # Build the requirements dict for each active undergraduate course in a single pass:
+        #   pways: Pathways area from the designation (RxxC, RxxD, RxxR, FxxC, ...), if any
+        #   copt:  COPT designation or attribute
+        #   equiv: values of the ME* attributes; null if the attribute string is malformed
+        #   plans: academic plans from dgw.courses
+        cursor.execute("""
+        UPDATE cuny_courses AS c
+           SET requirements = json_build_object(
+                 'pways', (regexp_match(c.designation, '^[RF](..)[CDR]$'))[1],
+                 'copt',  coalesce(c.designation, '') LIKE 'CO%'
+                          OR strpos(coalesce(c.attributes, ''), 'COPT') > 0,
+                 'equiv', (
+                   -- Same as dict(part.strip().split(':', 1) ...) in Python: a repeated key
+                   -- keeps its first position but its last value, and any non-empty part without
+                   -- a ':' makes the whole list null. Parts are trimmed of ASCII whitespace.
+                   SELECT CASE
+                            WHEN bool_or(strpos(kv.t, ':') = 0) THEN NULL
+                            ELSE coalesce(json_agg(kv.value ORDER BY kv.first_n)
+                                            FILTER (WHERE kv.is_last AND kv.key LIKE 'ME%'),
+                                          '[]'::json)
+                          END
+                   FROM (
+                     SELECT x.t,
+                            split_part(x.t, ':', 1) AS key,
+                            substr(x.t, strpos(x.t, ':') + 1) AS value,
+                            min(p.n) OVER w AS first_n,
+                            p.n = max(p.n) OVER w AS is_last
+                     FROM regexp_split_to_table(coalesce(c.attributes, ''), ';')
+                          WITH ORDINALITY AS p(part, n)
+                     CROSS JOIN LATERAL btrim(p.part, E' \\t\\n\\r\\f\\x0b') AS x(t)
+                     WHERE x.t <> ''
+                     WINDOW w AS (PARTITION BY split_part(x.t, ':', 1))
+                   ) AS kv),
+                 'plans', pl.plans)
+          FROM (
+            SELECT
+              cc.course_id,
+              cc.offer_nbr,
+              COALESCE(
+                json_agg(DISTINCT dc.plan ORDER BY dc.plan)
+                  FILTER (WHERE dc.plan IS NOT NULL),
+                '[]'::json
+              ) AS plans
+            FROM cuny_courses AS cc
+            LEFT JOIN dgw.courses AS dc
+              ON cc.course_id = split_part(dc.course_id, ':', 1)::int
+            AND cc.offer_nbr = split_part(dc.course_id, ':', 2)::int
+            WHERE cc.career = 'UGRD'
+              AND cc.course_status = 'A'
+            GROUP BY cc.course_id, cc.offer_nbr
+          ) AS pl
+         WHERE c.course_id = pl.course_id
+           AND c.offer_nbr = pl.offer_nbr
+        """)
 
-        # Update the cuny_courses.requirements column for this course
+        # Refresh the planner's statistics after rewriting the requirements column.
         cursor.execute("""
-        update cuny_courses set requirements = %s
-        where course_id = %s
-          and offer_nbr = %s
-        """, (Json(requirements), row.course_id, row.offer_nbr))
+        analyze cuny_courses
+        """)
 
 
 if __name__ == '__main__':